@@ -1,17 +1,82 @@
 #!/usr/bin/env python3
 
-import json
+import contextlib
 import operator
+import os
+import selectors
+import shutil
+import signal
 import subprocess
+import sys
 import argparse
+import threading
 import time
+import traceback
+
+try:
+  from orjson import loads as json_loads
+except ImportError:
+  from json import loads as json_loads
 
 from prometheus_client import start_http_server
 from prometheus_client.core import InfoMetricFamily, GaugeMetricFamily, CounterMetricFamily, REGISTRY
 
 
+# subprocess only uses posix_spawn (rather than fork + exec, which has to
+# copy the exporter's page tables) when given an executable path and
+# close_fds=False. The latter is safe since Python creates its file
+# descriptors non-inheritable.
+SMARTCTL = shutil.which('smartctl') or 'smartctl'
+
+
+def spawn_smartctl(*flags):
+  # =c: compact output, without the indentation that otherwise makes up a
+  # good part of what has to be read and parsed
+  return subprocess.Popen([SMARTCTL, '--json=c', *flags], stdout=subprocess.PIPE, close_fds=False)
+
+
 def smartctl(*flags):
-  return json.loads(subprocess.run(['smartctl', '--json', *flags], stdout=subprocess.PIPE, encoding='utf-8').stdout)
+  # both parsers accept bytes, so the output is never decoded to a str first
+  with spawn_smartctl(*flags) as p:
+    return json_loads(p.stdout.read())
+
+
+def smartctl_each(devices, *flags, timeout=300):
+  # Starts one smartctl per device up front and reads their output as it
+  # arrives, so that the (slow) device queries all overlap. Returns the parsed
+  # output per device, in the order of devices; None for devices where
+  # smartctl didn't finish within timeout seconds or its output couldn't be
+  # parsed.
+  results = dict.fromkeys(devices)
+  deadline = time.monotonic() + timeout
+  with contextlib.ExitStack() as stack, selectors.DefaultSelector() as sel:
+    for dev in devices:
+      p = stack.enter_context(spawn_smartctl(*flags, dev))
+      sel.register(p.stdout, selectors.EVENT_READ, (dev, p, []))
+
+    while sel.get_map():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      for key, _ in sel.select(remaining):
+        dev, p, chunks = key.data
+        chunk = os.read(key.fd, 65536)
+        if chunk:
+          chunks.append(chunk)
+        else:
+          sel.unregister(key.fileobj)
+          try:
+            results[dev] = json_loads(b''.join(chunks))
+          except ValueError as e:
+            print(f'{dev}: could not parse smartctl output: {e}', file=sys.stderr)
+
+    # whatever is left timed out; kill it so that leaving the ExitStack
+    # (which waits for each process) doesn't block
+    for key in sel.get_map().values():
+      dev, p, _ = key.data
+      print(f'{dev}: smartctl timed out after {timeout} seconds', file=sys.stderr)
+      p.kill()
+  return results
 
 
 def get_smartctl_version_info():
@@ -27,7 +92,8 @@ def get_smartctl_version_info():
 
 
 def get_devices():
-  return [x['name'] for x in smartctl('--scan-open')['devices']]
+  # device name: protocol
+  return {x['name']: x['protocol'] for x in smartctl('--scan-open')['devices']}
 
 
 def get_device_info(device_data):
@@ -47,19 +113,53 @@ def get_device_info(device_data):
   return info
 
 
-def dig(data, path):
-  p = list(path)
-  d = data
-  while len(p) > 0:
-    n = p.pop(0)
-    d = operator.getitem(d, n)
-  return d
+def make_getter(path, transform=None):
+  if transform is None and len(path) == 1:
+    return operator.itemgetter(path[0])
+  # compiles to e.g. lambda d: d['raw']['value'] (or transform(d['value'])),
+  # i.e. plain subscripts and at most one call
+  expr = 'd' + ''.join(f'[{k!r}]' for k in path)
+  if transform is not None:
+    expr = f'transform({expr})'
+  return eval('lambda d: ' + expr, {'transform': transform})
+
+
+def identity(x):
+  return x
+
+
+def airflow_temperature(x):
+  return 100-x
+
+
+def temperature_from_string(x):
+  # e.g. '35 (Min/Max 20/40)', only the leading value is needed
+  return float(x.partition(' ')[0])
+
+
+def percentage_to_ratio(x):
+  return x/100
+
+
+def data_units_to_bytes(x):
+  # the factor is hardcoded in smartmontools' text output
+  return x*1000*512
+
+
+def new_metric_family(template):
+  type_, name, help_ = template
+  return type_(name, help_, labels=['device'])
+
+
+# The gen_*_metrics() functions return templates, (type, name, help), in
+# place of the metric families. They are built once per collector, and
+# new_metric_family() is used to instantiate them on each refresh.
 
 
 def gen_metrics():
-  # metric, path, (transform)
+  # metric template, getter, transform
   return [
-    (GaugeMetricFamily('smartmon_smart_healthy', 'Whether the device is healthy according to S.M.A.R.T.', labels=['device']), ('smart_status', 'passed'), int),
+    ((GaugeMetricFamily, 'smartmon_smart_healthy', 'Whether the device is healthy according to S.M.A.R.T.'), make_getter(('smart_status', 'passed')), int),
   ]
 
 
@@ -104,7 +204,7 @@ def gen_attr_metrics():
       'name': 'airflow_temperature_celsius',
       'type': GaugeMetricFamily,
       'path': ('value',),
-      'transform': lambda x: 100-x,
+      'transform': airflow_temperature,
     },
     193: {
       'name': 'load_cycles_total',
@@ -115,7 +215,7 @@ def gen_attr_metrics():
       'name': 'temperature_celsius',
       'type': GaugeMetricFamily,
       'path': ('raw', 'string'),
-      'transform': lambda x: float(x.split()[0])
+      'transform': temperature_from_string,
     },
     196: {
       'name': 'reallocated_events_total',
@@ -138,23 +238,25 @@ def gen_attr_metrics():
       'path': ('raw', 'value'),
     },
   }
-  return {i: (a['type']('smartmon_' + a['name'], a.get('doc', a['name']), labels=['device']), a['path'], a.get('transform', lambda x: x)) for i, a in attrs.items()}
-
-
-def identity(x):
-  return x
+  # metric and getter (with the transform, if any, folded in) as parallel
+  # tables indexed by attribute id (which is a single byte), None for
+  # attributes that aren't exported
+  attr_metrics = ([None] * 256, [None] * 256)
+  for i, a in attrs.items():
+    attr_metrics[0][i] = (a['type'], 'smartmon_' + a['name'], a.get('doc', a['name']))
+    attr_metrics[1][i] = make_getter(a['path'], a.get('transform'))
+  return attr_metrics
 
 
 def gen_nvme_metrics():
   nvme_metrics = [
     # metric name, metric type, smartctl name, help, transform
     ('temperature_celsius', GaugeMetricFamily, 'temperature', 'temperature_celsius', identity),
-    ('nvme_available_spare_ratio', GaugeMetricFamily, 'available_spare', None, lambda x: x/100),
-    ('nvme_available_spare_threshold_ratio', GaugeMetricFamily, 'available_spare_threshold', None, lambda x: x/100),
-    ('nvme_used_ratio', GaugeMetricFamily, 'percentage_used', None, lambda x: x/100),
-    # the factor in the units_{read,written} transform is hardcoded in smartmontools' text output
-    ('nvme_data_units_read_bytes', CounterMetricFamily, 'data_units_read', 'NVME Data Units Read, converted to bytes (1 unit=512000 bytes)', lambda x: x*1000*512),
-    ('nvme_data_units_written_bytes', CounterMetricFamily, 'data_units_written', 'NVME Data Units Written, converted to bytes (1 unit=512000 bytes)', lambda x: x*1000*512),
+    ('nvme_available_spare_ratio', GaugeMetricFamily, 'available_spare', None, percentage_to_ratio),
+    ('nvme_available_spare_threshold_ratio', GaugeMetricFamily, 'available_spare_threshold', None, percentage_to_ratio),
+    ('nvme_used_ratio', GaugeMetricFamily, 'percentage_used', None, percentage_to_ratio),
+    ('nvme_data_units_read_bytes', CounterMetricFamily, 'data_units_read', 'NVME Data Units Read, converted to bytes (1 unit=512000 bytes)', data_units_to_bytes),
+    ('nvme_data_units_written_bytes', CounterMetricFamily, 'data_units_written', 'NVME Data Units Written, converted to bytes (1 unit=512000 bytes)', data_units_to_bytes),
     ('nvme_host_reads', CounterMetricFamily, 'host_reads', 'NVME Host Read Commands', identity),
     ('nvme_host_writes', CounterMetricFamily, 'host_writes', 'NVME Host Write Commands', identity),
     ('nvme_controller_busy_time', CounterMetricFamily, 'controller_busy_time', None, identity),
@@ -165,34 +267,102 @@ def gen_nvme_metrics():
     ('nvme_num_err_log_entries', CounterMetricFamily, 'num_err_log_entries', None, identity),
 
   ]
-  generated = []
-  for name, type_, key, help_, transform in nvme_metrics:
-    generated.append([type_(f'smartmon_{name}', help_ if help_ is not None else name, labels=['device']), key, transform])
-  return generated
+  # like gen_attr_metrics(), but as the values are read by key, a single
+  # itemgetter fetches all of them (in table order) at once
+  templates = [(type_, f'smartmon_{name}', help_ if help_ is not None else name) for name, type_, _, help_, _ in nvme_metrics]
+  getter = operator.itemgetter(*(key for _, _, key, _, _ in nvme_metrics))
+  transforms = [transform for _, _, _, _, transform in nvme_metrics]
+  return templates, getter, transforms
 
 
-def get_device_metrics(dev, info_metric, info_metric_labels, metrics, attr_metrics, nvme_metrics):
-  d = smartctl('--all', dev)
+# The get_*_metrics functions append (metric, value) to samples rather than
+# adding them to the metrics directly, so that nothing is added for a device
+# whose smartctl output turns out to be incomplete half way through.
 
-  info_metric.add_sample('smartmon_device_info', get_device_info(d), 1)
 
-  for m, path, transform in metrics:
-    m.add_metric([dev], transform(dig(d, path)))
+def get_ata_metrics(samples, d, attr_metrics):
+  attr_metric, attr_getter = attr_metrics
+  # absent for e.g. SCSI devices, and drives behind bridges without SAT passthrough
+  for attr in d.get('ata_smart_attributes', {}).get('table', ()):
+    i = attr['id']
+    m = attr_metric[i]
+    if m is not None:
+      samples.append((m, attr_getter[i](attr)))
 
-  if 'nvme_smart_health_information_log' in d:
-    for m, key, transform in nvme_metrics:
-      m.add_metric([dev], transform(d['nvme_smart_health_information_log'][key]))
-  else:
-    for attr in d['ata_smart_attributes']['table']:
-      if attr['id'] in attr_metrics:
-        m, path, transform = attr_metrics[attr['id']]
-        m.add_metric([dev], transform(dig(attr, path)))
 
+def get_nvme_metrics(samples, d, nvme_metrics):
+  nvme_metric, nvme_getter, nvme_transform = nvme_metrics
+  for m, transform, value in zip(nvme_metric, nvme_transform, nvme_getter(d['nvme_smart_health_information_log'])):
+    samples.append((m, transform(value)))
 
-class SmartmonCollector:
-  def collect(self):
-    yield InfoMetricFamily('smartmon', 'smartmontools information', get_smartctl_version_info())
 
+# protocol (as reported by --scan-open): get_*_metrics function, get_ata_metrics for the rest
+PROTOCOL_METRICS = {
+  'NVMe': get_nvme_metrics,
+}
+
+
+def get_device_metrics(dev, d, device_info, info_metric, info_metric_labels, metrics, get_protocol_metrics, protocol_metrics):
+  samples = [(m, transform(getter(d))) for m, getter, transform in metrics]
+  get_protocol_metrics(samples, d, protocol_metrics)
+
+  info_metric.add_sample('smartmon_device_info', device_info, 1)
+  # add_metric only reads the label values, so one list serves every sample
+  labels = [dev]
+  for m, value in samples:
+    m.add_metric(labels, value)
+
+
+class SmartmonCollector:
+  # --scan-open is only repeated this often (in seconds), to pick up added or removed devices
+  DEVICE_SCAN_INTERVAL = 3600
+  # Reading S.M.A.R.T. data interferes with regular I/O on the device (and
+  # may spin it up), so it is done on this interval (in seconds) rather than
+  # on every scrape
+  REFRESH_INTERVAL = 1800
+  # exit status smartctl is told to use (with -n standby,STATUS) when it skips
+  # a device because it's in standby. smartctl's own exit statuses are a
+  # bitmask, of which all bits set is not a plausible combination.
+  STANDBY_EXIT_STATUS = 255
+
+  def __init__(self, refresh_interval=REFRESH_INTERVAL):
+    self._version_metric = InfoMetricFamily('smartmon', 'smartmontools information', get_smartctl_version_info())
+    self._devices = None
+    self._devices_scanned = None
+    self._refresh_interval = refresh_interval
+    # last successful smartctl output per device, for devices in standby
+    self._device_data = {}
+    # device name: ((serial number, firmware version), get_device_info() output)
+    self._device_info = {}
+    self._lock = threading.Lock()
+    self._snapshot = [self._version_metric]
+    # whether the last refresh read every device, and when a refresh last completed
+    self._refresh_success = False
+    self._refresh_time = None
+    self._metrics = gen_metrics()
+    self._attr_metrics = gen_attr_metrics()
+    self._nvme_metrics = gen_nvme_metrics()
+    threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+  def get_devices(self):
+    # device name: get_*_metrics function for its protocol
+    now = time.monotonic()
+    if self._devices is None or now - self._devices_scanned > self.DEVICE_SCAN_INTERVAL:
+      self._devices = {dev: PROTOCOL_METRICS.get(protocol, get_ata_metrics) for dev, protocol in get_devices().items()}
+      self._devices_scanned = now
+    return self._devices
+
+  def _refresh_loop(self):
+    while True:
+      try:
+        self.refresh()
+      except Exception:
+        traceback.print_exc()
+        with self._lock:
+          self._refresh_success = False
+      time.sleep(self._refresh_interval)
+
+  def refresh(self):
     dev_info_labels = [
       'device',
       'type',
@@ -204,26 +374,102 @@ class SmartmonCollector:
     ]
     dev_info_metric = InfoMetricFamily('smartmon_device', 'S.M.A.R.T. device information')
 
-    metrics = gen_metrics()
-    attr_metrics = gen_attr_metrics()
-    nvme_metrics = gen_nvme_metrics()
+    metrics = [(new_metric_family(t), getter, transform) for t, getter, transform in self._metrics]
+    attr_templates, attr_getters = self._attr_metrics
+    attr_metrics = ([None if t is None else new_metric_family(t) for t in attr_templates], attr_getters)
+    nvme_templates, nvme_getter, nvme_transforms = self._nvme_metrics
+    nvme_metrics = ([new_metric_family(t) for t in nvme_templates], nvme_getter, nvme_transforms)
+    protocol_metrics = {
+      get_ata_metrics: attr_metrics,
+      get_nvme_metrics: nvme_metrics,
+    }
+
+    # -n standby: don't wake up sleeping drives, keep reporting what they said
+    # last. Any other failure to read the device drops its samples.
+    # --info --health --attributes: only the sections read by get_device_metrics(),
+    # --all would also fetch the error and self-test logs from the device
+    devices = self.get_devices()
+    success = dict.fromkeys(devices, False)
+    device_data = {}
+    for dev, d in smartctl_each(devices, '-n', f'standby,{self.STANDBY_EXIT_STATUS}', '--info', '--health', '--attributes').items():
+      if d is None:
+        continue
+      exit_status = d.get('smartctl', {}).get('exit_status')
+      if exit_status == self.STANDBY_EXIT_STATUS:
+        success[dev] = True
+        if dev in self._device_data:
+          device_data[dev] = self._device_data[dev]
+      elif 'smart_status' in d:
+        device_data[dev] = d
+      else:
+        print(f'{dev}: no S.M.A.R.T. data from smartctl (exit status {exit_status})', file=sys.stderr)
+
+    device_info = {}
+    for dev, d in list(device_data.items()):
+      try:
+        # the device information only changes with a new drive (or firmware)
+        key = (d['serial_number'], d['firmware_version'])
+        cached = self._device_info.get(dev)
+        info = cached if cached is not None and cached[0] == key else (key, get_device_info(d))
+
+        get_protocol_metrics = devices[dev]
+        get_device_metrics(dev, d, info[1], dev_info_metric, dev_info_labels, metrics, get_protocol_metrics, protocol_metrics[get_protocol_metrics])
+      except Exception:
+        # skip only this device, and don't keep its output around for standby
+        print(f'{dev}: unexpected smartctl output', file=sys.stderr)
+        traceback.print_exc()
+        success[dev] = False
+        del device_data[dev]
+        continue
+      device_info[dev] = info
+      success[dev] = True
+    self._device_info = device_info
+
+    success_metric = GaugeMetricFamily('smartmon_device_refresh_success', 'Whether S.M.A.R.T. data could be read from the device in the last refresh', labels=['device'])
+    for dev, ok in success.items():
+      success_metric.add_metric([dev], int(ok))
+
+    # a published snapshot is never modified, so collect() can yield from it
+    # without holding the lock
+    snapshot = [self._version_metric, dev_info_metric, success_metric]
+    snapshot.extend(x[0] for x in metrics)
+    snapshot.extend(m for m in attr_metrics[0] if m is not None)
+    snapshot.extend(nvme_metrics[0])
+
+    with self._lock:
+      self._device_data = device_data
+      self._snapshot = snapshot
+      self._refresh_success = all(success.values())
+      self._refresh_time = time.time()
+
+  def collect(self):
+    with self._lock:
+      snapshot = self._snapshot
+      refresh_success = self._refresh_success
+      refresh_time = self._refresh_time
+    yield from snapshot
+    # these also cover refreshes that failed altogether, which leave the
+    # previous snapshot in place
+    yield GaugeMetricFamily('smartmon_last_refresh_success', 'Whether the last refresh read S.M.A.R.T. data from every device', value=int(refresh_success))
+    if refresh_time is not None:
+      yield GaugeMetricFamily('smartmon_last_refresh_timestamp_seconds', 'When S.M.A.R.T. data was last refreshed', value=refresh_time)
 
-    for dev in get_devices():
-      get_device_metrics(dev, dev_info_metric, dev_info_labels, metrics, attr_metrics, nvme_metrics)
 
-    yield dev_info_metric
-    yield from (x[0] for x in metrics)
-    yield from (x[0] for x in attr_metrics.values())
-    yield from (x[0] for x in nvme_metrics)
+def positive_int(s):
+  value = int(s)
+  if value < 1:
+    raise argparse.ArgumentTypeError(f'must be at least 1: {value}')
+  return value
 
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='Prometheus exporter for S.M.A.R.T. metrics.')
   parser.add_argument('--listen-address', '-a', metavar='ADDRESS', type=str, default='', help='Address the exporter should listen on. Default: all')
   parser.add_argument('--listen-port', '-p', metavar='PORT', type=int, default=9541, help='Port the exporter should listen on. Default: 9541')
+  parser.add_argument('--refresh-interval', '-i', metavar='SECONDS', type=positive_int, default=SmartmonCollector.REFRESH_INTERVAL, help=f'How often S.M.A.R.T. data is read from the devices. Default: {SmartmonCollector.REFRESH_INTERVAL}')
   args = parser.parse_args()
 
-  REGISTRY.register(SmartmonCollector())
+  REGISTRY.register(SmartmonCollector(args.refresh_interval))
   start_http_server(args.listen_port, args.listen_address)
-  while True:
-    time.sleep(60)
+  # the HTTP server and the refresh loop run in their own threads
+  signal.pause()